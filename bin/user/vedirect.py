@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # Copyright 2018-2022 Matthew Wall
 # Distributed under the terms of the GNU Public License (GPLv3)
 #
@@ -81,40 +81,39 @@
 #  WARN           warning reason
 
 DRIVER_NAME = "VEDirect"
-DRIVER_VERSION = "0.2"
+DRIVER_VERSION = "0.3"
 DEFAULT_PORT = '/dev/ttyUSB0'
+MIN_POLL_INTERVAL = 0.1 # seconds
 
+import sys
+
+if sys.version_info[0] < 3:
+    raise ImportError("vedirect driver %s requires python 3" % DRIVER_VERSION)
+
+import logging
 import os
+import queue
+import re
 import serial
-import syslog
+import threading
 import time
 
+import weeutil.logger
+import weeutil.weeutil
 import weewx.drivers
 import weewx.engine
 import weewx.units
 
-try:
-    # New-style weewx logging
-    import weeutil.logger
-    import logging
-    log = logging.getLogger(__name__)
-    def logdbg(msg):
-        log.debug(msg)
-    def loginf(msg):
-        log.info(msg)
-    def logerr(msg):
-        log.error(msg)
-except ImportError:
-    # Old-style weewx logging
-    import syslog
-    def logmsg(level, msg):
-        syslog.syslog(level, 'vedirect: %s: %s' % msg)
-    def logdbg(msg):
-        logmsg(syslog.LOG_DEBUG, msg)
-    def loginf(msg):
-        logmsg(syslog.LOG_INFO, msg)
-    def logerr(msg):
-        logmsg(syslog.LOG_ERR, msg)
+log = logging.getLogger(__name__)
+
+def logdbg(msg, *args):
+    log.debug(msg, *args)
+
+def loginf(msg, *args):
+    log.info(msg, *args)
+
+def logerr(msg, *args):
+    log.error(msg, *args)
 
 
 def loader(config_dict, engine):
@@ -168,6 +167,31 @@ schema = [
     ('H23',       'REAL'), # H23 (W)
 ]
 
+# values that make an on/off field 0.  anything else is 1.
+BOOL_FALSE = frozenset(['0', 'OFF'])
+
+def _onoff(v):
+    return 0 if v in BOOL_FALSE else 1
+
+def _milli(v):
+    return float(v) / 1000.0
+
+# map VE.Direct labels to packet fields and the conversion for each value
+FIELD_SPECS = {
+    'ERR': ('error', _onoff),
+    'LOAD': ('load', _onoff),
+    'CS': ('CS', int),
+    'PPV': ('PPV', int),
+    'I': ('I', _milli),
+    'V': ('V', _milli),
+    'VPV': ('VPV', _milli),
+    'H19': ('H19', int),
+    'H20': ('H20', int),
+    'H21': ('H21', int),
+    'H22': ('H22', int),
+    'H23': ('H23', int),
+}
+
 weewx.units.obs_group_dict['range'] = 'group_range'
 weewx.units.obs_group_dict['range2'] = 'group_range'
 weewx.units.obs_group_dict['range3'] = 'group_range'
@@ -186,6 +210,16 @@ class VEDirectConfigurationEditor(weewx.drivers.AbstractConfEditor):
     # The port to which the device is connected
     port = /dev/ttyUSB0
 
+    # How long to wait for data, in seconds.  The wait starts at
+    # min_poll_interval and grows toward max_poll_interval while the
+    # device is quiet.
+    #min_poll_interval = 1
+    #max_poll_interval = 10
+
+    # Which fields to put in each packet.  Use the packet field names, for
+    # example error and load, not the VE.Direct labels ERR and LOAD.
+    #subscribed_fields = error, load, CS, PPV, I, V, VPV, H19, H20, H21, H22, H23
+
     # The driver to use
     driver = user.vedirect
 """
@@ -200,11 +234,32 @@ class VEDirectDriver(weewx.drivers.AbstractDevice):
     def __init__(self, **stn_dict):
         loginf('driver version is %s' % DRIVER_VERSION)
         self._model = stn_dict.get('model', 'VEDirect')
-        self._poll_interval = int(stn_dict.get('poll_interval', 1))
-        loginf('poll interval is %s' % self._poll_interval)
+        # reads block until data arrive or the poll interval passes.  the
+        # interval is min_poll_interval while data are arriving, and backs
+        # off toward max_poll_interval while the device is quiet.
+        # a zero or negative interval would make the reads spin, so keep
+        # the interval above a small floor.
+        self._min_poll_interval = max(MIN_POLL_INTERVAL, float(stn_dict.get(
+            'min_poll_interval', stn_dict.get('poll_interval', 1))))
+        self._max_poll_interval = max(self._min_poll_interval, float(
+            stn_dict.get('max_poll_interval', 10)))
+        loginf('poll interval is %s to %s' %
+               (self._min_poll_interval, self._max_poll_interval))
+        # only the packet fields listed here are decoded
+        fields = stn_dict.get('subscribed_fields')
+        if fields is None:
+            fields = [name for name, _ in FIELD_SPECS.values()]
+        self._subscribed = frozenset(weeutil.weeutil.option_as_list(fields))
+        loginf('subscribed fields: %s' % ', '.join(sorted(self._subscribed)))
+        handlers = dict()
+        for k, (name, conv) in FIELD_SPECS.items():
+            if name in self._subscribed:
+                handlers[k] = (name, conv)
         port = stn_dict.get('port', DEFAULT_PORT)
         loginf('port is %s' % port)
-        self._ved = VEDirect(port)
+        self._ved = VEDirect(port, timeout=self._min_poll_interval,
+                             handlers=handlers)
+        self._time = time.time
         self._ved.open()
 
     def closePort(self):
@@ -215,69 +270,67 @@ class VEDirectDriver(weewx.drivers.AbstractDevice):
         return self._model
 
     def genLoopPackets(self):
+        timeout = self._min_poll_interval
         while True:
             data = self._ved.get_data()
-            if data:
-                logdbg("raw data: %s" % data)
+            if data is not None:
+                if timeout != self._min_poll_interval:
+                    timeout = self._min_poll_interval
+                    self._ved.set_timeout(timeout)
                 packet = self._data_to_packet(data)
-                logdbg("packet: %s" % packet)
+                logdbg("packet: %s", packet)
                 if packet:
                     yield packet
-            time.sleep(self._poll_interval)
-                
+            elif timeout < self._max_poll_interval:
+                timeout = min(self._max_poll_interval, timeout * 2)
+                self._ved.set_timeout(timeout)
 
     def _data_to_packet(self, data):
-        # convert raw data to database fields
-        # {'LOAD': 'OFF', 'H19': '467', 'VPV': '56790', 'ERR': '0', 'FW': '130', 'I': '6900', 'H21': '96', 'PID': '0xA056', 'H20': '4', 'H23': '117', 'H22': '22', 'HSDS': '25', 'SER#': 'HQ1804IWW4P', 'V': '13580', 'CS': '3', 'PPV': '96'}
-
-        # FW: firmware version
-        # SER#: serial number
-        # PID: product ID
-        # HSDS: 
-        
-        pkt = dict()
-        if 'ERR' in data:
-            pkt['error'] = 0 if data.get('ERR', '0') == '0' else 1
-        if 'LOAD' in data:
-            pkt['load'] = 0 if data.get('LOAD', 'OFF') == 'OFF' else 1
-        if 'CS' in data:
-            pkt['CS'] = int(data['CS'])
-        for k in ['PPV']:
-            if k in data:
-                pkt[k] = int(data[k])
-        for k in ['I', 'V', 'VPV']:
-            if k in data:
-                pkt[k] = float(data[k]) / 1000.0
-        for k in ['H19', 'H20', 'H21', 'H22', 'H23']:
-            if k in data:
-                pkt[k] = int(data[k])
+        # the VEDirect object has already converted the values to database
+        # fields, for example
+        # {'load': 0, 'H19': 467, 'VPV': 56.79, 'error': 0, 'I': 6.9, 'H21': 96, 'H20': 4, 'H23': 117, 'H22': 22, 'V': 13.58, 'CS': 3, 'PPV': 96}
 
         # if we actually ended up with something, then make it a weewx packet
-        if pkt:
-            pkt['dateTime'] = int(time.time() + 0.5)
-            pkt['usUnits'] = weewx.US
-        return pkt
+        if data:
+            data['dateTime'] = int(round(self._time()))
+            data['usUnits'] = weewx.US
+        return data
 
 
 class VEDirect:
 
-    (HEX, WAIT_HEADER, IN_KEY, IN_VALUE, IN_CHECKSUM) = range(5)
+    # every text block ends with this label followed by the checksum byte
+    CHECKSUM_LABEL = b'\r\nChecksum\t'
+    # hex protocol messages start with this and end with a newline
+    HEX_MARKER = b':'
 
-    def __init__(self, port):
+    def __init__(self, port, timeout=3, handlers=None):
         self.ser = None
         self.port = port
         self.baudrate = 19200
-        self.timeout = 3
-        self.header1 = '\r'
-        self.header2 = '\n'
-        self.hexmarker = ':'
-        self.delimiter = '\t'
-        self.key = ''
+        self.timeout = timeout
+        # optional map of label to (field, conversion).  when specified,
+        # packets contain only the converted fields, otherwise they contain
+        # every label with its value as a string.
+        self.handlers = handlers
         self.start = ''
-        self.value = ''
-        self.bytes_sum = 0;
-        self.state = self.WAIT_HEADER
         self.values = {}
+        # compiled patterns for the blocks we have seen, keyed by the first
+        # label in the block
+        self.templates = {}
+        self.max_read = 256
+        self.buf = bytearray()
+        # how much of the buffer has been searched for the checksum label,
+        # and how big the buffer may get before we give up on finding it
+        self.scanned = 0
+        self.max_buf = 4096
+        # packets from the reader thread.  if nobody takes them, the oldest
+        # are dropped so the reader never stops draining the port.
+        self.queue = queue.Queue(maxsize=16)
+        self._stop = threading.Event()
+        self._thread = None
+        # the error that stopped the reader thread, if any
+        self._error = None
 
     def __enter__(self):
         self.open()
@@ -289,79 +342,196 @@ class VEDirect:
     def open(self):
         self.ser = serial.Serial(
             self.port, self.baudrate, timeout=self.timeout)
+        self._stop.clear()
+        self._error = None
+        self._thread = threading.Thread(target=self._reader_loop)
+        self._thread.daemon = True
+        self._thread.start()
 
     def close(self):
+        # the reader may be blocked in a read for up to the current timeout
+        # before it sees the stop request
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
         if self.ser is not None:
             self.ser.close()
             self.ser = None
 
-    def input(self, byte):
-        if byte == self.hexmarker and self.state != self.IN_CHECKSUM:
-            self.state = self.HEX
-        if self.state == self.WAIT_HEADER:
-            self.bytes_sum += ord(byte)
-            if byte == self.header1:
-                self.state = self.WAIT_HEADER
-            elif byte == self.header2:
-                self.state = self.IN_KEY
+    def set_timeout(self, timeout):
+        # how long get_data waits for a packet, and how long each read waits
+        # for data.  the reader thread picks up the change before its next
+        # read.
+        self.timeout = timeout
+
+    def feed(self, data):
+        # add bytes from the device to the buffer.  return a packet if the
+        # buffer now holds one, otherwise None.  whatever follows a packet
+        # stays in the buffer for the next call.
+        buf = self.buf
+        buf += data
+        label = self.CHECKSUM_LABEL
+        size = len(label) + 1
+        while True:
+            idx = buf.find(label, self.scanned)
+            if idx < 0:
+                # only search the new bytes next time.  the label might
+                # straddle the end of the buffer, so back up a little.
+                if len(buf) > self.max_buf:
+                    del buf[:-len(label)]
+                self.scanned = max(0, len(buf) - len(label) + 1)
+                return None
+            end = idx + size
+            if end > len(buf):
+                self.scanned = idx
+                return None
+            frame = bytes(buf[:end])
+            del buf[:end]
+            self.scanned = 0
+            packet = self._parse_frame(frame, idx)
+            if packet is not None:
+                return packet
+
+    def _parse_frame(self, frame, idx):
+        if frame.find(self.HEX_MARKER, 0, idx) >= 0:
+            frame = self._strip_hex(frame, idx)
+        # all bytes of a block, including the checksum byte, add up to 0
+        # modulo 256.  sum() over bytes is faster here than over a
+        # memoryview of the buffer, since blocks are only a few hundred bytes.
+        if sum(frame) & 0xFF:
+            # malformed packet
+            self.start = ''
+            self.values.clear()
             return None
-        elif self.state == self.IN_KEY:
-            self.bytes_sum += ord(byte)
-            if byte == self.delimiter:
-                if self.start == self.key:
-                    self.start = 'ALL'
-                elif self.start == '':
-                    self.start = self.key
-                if self.key == 'Checksum':
-                    self.state = self.IN_CHECKSUM
-                else:
-                    self.state = self.IN_VALUE
+        start = self.start
+        values = self.values
+        # decode the block in one call rather than each label and value.
+        # devices send the same labels in the same order every time, so try
+        # the pattern for a block that starts with the same label first.
+        text = frame[:-1].decode('ascii', 'replace')
+        if log.isEnabledFor(logging.DEBUG):
+            # every label, including those without a handler
+            logdbg("raw data: %r", text)
+        template = self.templates.get(text[2:text.find('\t')])
+        match = template[0].match(text) if template is not None else None
+        try:
+            if match is not None:
+                keys = template[1]
+                for (name, conv), value in zip(template[2], match.groups()):
+                    values[name] = conv(value)
             else:
-                self.key += byte
+                keys = self._parse_lines(text, values)
+        except ValueError as e:
+            # the checksum was good but a value is not what we expected, so
+            # drop the block rather than stopping the reader
+            logerr("bad value in block %r: %s", text, e)
+            self.start = ''
+            values.clear()
             return None
-        elif self.state == self.IN_VALUE:
-            self.bytes_sum += ord(byte)
-            if byte == self.header1:
-                self.state = self.WAIT_HEADER
-                self.values[self.key] = self.value;
-                self.key = '';
-                self.value = '';
+        if start == '':
+            start = keys[0]
+        elif start in keys:
+            start = 'ALL'
+        if start == 'ALL':
+            # hand out a copy so the dict can be reused for the next packet
+            self.start = ''
+            packet = values.copy()
+            values.clear()
+            return packet
+        self.start = start
+        return None
+
+    def _parse_lines(self, text, values):
+        # parse the block one line at a time, and remember its shape as a
+        # pattern for the blocks that follow.  return the labels.
+        # anything before the first line break is the tail of a block that
+        # we did not see the start of.
+        handlers = self.handlers
+        keys = []
+        fields = []
+        pattern = []
+        for line in text.split('\r\n')[1:]:
+            key, _, value = line.partition('\t')
+            keys.append(key)
+            if key == 'Checksum':
+                continue
+            if handlers is None:
+                spec = (key, str)
             else:
-                self.value += byte
-            return None
-        elif self.state == self.IN_CHECKSUM:
-            self.bytes_sum += ord(byte)
-            self.key = ''
-            self.value = ''
-            self.state = self.WAIT_HEADER
-            if self.bytes_sum % 256 == 0:
-                self.bytes_sum = 0
-                if self.start == 'ALL':
-                    self.start = ''
-                    return self.values
-                else:
-                    return None
+                spec = handlers.get(key)
+            if spec is None:
+                pattern.append(r'\r\n%s\t[^\r\n]*' % re.escape(key))
             else:
-                # malformed packet
-                self.bytes_sum = 0
-                self.start = ''
-                self.values = dict()
-        elif self.state == self.HEX:
-            self.bytes_sum = 0
-            if byte == self.header2:
-                self.state = self.WAIT_HEADER
-        else:
-            raise AssertionError()
+                pattern.append(r'\r\n%s\t([^\r\n]*)' % re.escape(key))
+                fields.append(spec)
+                values[spec[0]] = spec[1](value)
+        if text.startswith('\r\n') and keys[-1] == 'Checksum':
+            pattern.append(r'\r\nChecksum\t\Z')
+            self.templates[keys[0]] = (
+                re.compile(''.join(pattern)), tuple(keys), tuple(fields))
+        return keys
+
+    def _strip_hex(self, frame, idx):
+        # the device may send hex messages in the middle of a text block.
+        # they are not part of the block checksum, so cut them out and keep
+        # the text on either side.
+        parts = []
+        pos = 0
+        while True:
+            hexpos = frame.find(self.HEX_MARKER, pos, idx)
+            if hexpos < 0:
+                break
+            parts.append(frame[pos:hexpos])
+            pos = frame.find(b'\n', hexpos) + 1
+        parts.append(frame[pos:])
+        return b''.join(parts)
 
     def get_data(self):
+        # wait for the next packet from the reader thread.  return None if
+        # nothing arrives before the timeout.  once the reader has failed,
+        # hand out what it queued and then raise its error on every call.
+        try:
+            return self.queue.get(block=self._error is None,
+                                  timeout=self.timeout)
+        except queue.Empty:
+            if self._error is not None:
+                raise self._error
+            return None
+
+    def _reader_loop(self):
+        # read whatever is waiting in a single call.  when nothing is
+        # waiting the read blocks for the first byte or until the timeout.
+        try:
+            while not self._stop.is_set():
+                if self.ser.timeout != self.timeout:
+                    self.ser.timeout = self.timeout
+                packet = self.feed(self.ser.read(self._read_size()))
+                while packet is not None:
+                    self._put(packet)
+                    packet = self.feed(b'')
+        except Exception as e:
+            # let get_data report the failure
+            logerr("reader stopped: %s", e)
+            self._error = e
+
+    def _put(self, item):
         while True:
-            byte = self.ser.read(1)
-            if byte:
-                packet = self.input(byte)
-                if packet is not None:
-                    return packet
-            else:
-                break
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _read_size(self):
+        try:
+            return max(1, min(self.max_read, self.ser.in_waiting))
+        except AttributeError:
+            # older pyserial has no in_waiting
+            return 64
 
 
 # define a main entry point for basic testing of the station without weewx
@@ -373,9 +543,7 @@ if __name__ == '__main__':
     import optparse
 
     usage = """%prog [options] [--debug] [--help]"""
-    
-    syslog.openlog('vedirect', syslog.LOG_PID | syslog.LOG_CONS)
-    syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_INFO))
+
     parser = optparse.OptionParser(usage=usage)
     parser.add_option('--version', dest='version', action='store_true',
                       help='display driver version')
@@ -391,8 +559,9 @@ if __name__ == '__main__':
         print("vedirect driver version %s" % DRIVER_VERSION)
         exit(1)
 
-    if options.debug:
-        syslog.setlogmask(syslog.LOG_UPTO(syslog.LOG_DEBUG))
+    logging.basicConfig(
+        format='vedirect: %(levelname)s: %(message)s',
+        level=logging.DEBUG if options.debug else logging.INFO)
 
     with VEDirect(options.port) as s:
         while True:
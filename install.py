@@ -10,7 +10,7 @@ def loader():
 class VEDirectInstaller(ExtensionInstaller):
     def __init__(self):
         super(VEDirectInstaller, self).__init__(
-            version="0.2",
+            version="0.3",
             name='vedirect',
             description='Collect data from Victron VEDirect devices',
             author="Matthew Wall",